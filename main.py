@@ -1,25 +1,41 @@
+import asyncio
+import logging
 import os
+import re
+import time
 from datetime import datetime, timedelta, timezone
 from typing import List, Optional
-from fastapi import FastAPI, HTTPException, Request
+from urllib.parse import urlsplit
+from cachetools import LRUCache, TTLCache
+from fastapi import FastAPI, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict
 from bson import ObjectId
+from pymongo.errors import DuplicateKeyError
 
-from database import db, create_document, get_documents
+from database import db, create_document, create_documents
+from migrate_idea_ids import migrate_idea_ids
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+logger = logging.getLogger(__name__)
+
+# Comma-separated allowlist; without one, allow any origin but no credentials
+frontend_origins = [o.strip() for o in os.getenv("FRONTEND_ORIGIN", "").split(",") if o.strip()]
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
+    allow_origins=frontend_origins or ["*"],
+    allow_credentials=bool(frontend_origins),
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type", "authorization"],
+    max_age=86400,
 )
 
 # --------- Pydantic models for requests ---------
 class IdeaCreate(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, frozen=True)
+
     title: str
     description: str
     author: Optional[str] = None
@@ -27,32 +43,71 @@ class IdeaCreate(BaseModel):
     tags: List[str] = []
 
 class CommentCreate(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, frozen=True)
+
     idea_id: str
     author: Optional[str] = None
     content: str
 
 class VoteCreate(BaseModel):
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True, frozen=True)
+
     idea_id: str
     voter: Optional[str] = None
 
 # --------- Utility ---------
 
+# Rendered ranked idea lists keyed by (period, sort, limit); cleared on every write
+ideas_cache = TTLCache(maxsize=32, ttl=120)
+# Bumped on every clear so a ranking computed across a write is not stored
+ideas_generation = 0
+# Idea ids known to exist; ideas are never deleted so positive entries stay valid
+known_ideas = LRUCache(maxsize=10_000)
+
+SCHEME_RE = re.compile(r"^[a-z][a-z0-9+.\-]*://", re.I)
+
+def invalidate_ideas():
+    global ideas_generation
+    ideas_generation += 1
+    ideas_cache.clear()
+
 def serialize_doc(doc):
-    doc["id"] = str(doc.get("_id"))
-    doc.pop("_id", None)
-    # convert datetimes to isoformat
-    for k in ["created_at", "updated_at"]:
-        if k in doc and isinstance(doc[k], datetime):
-            doc[k] = doc[k].isoformat()
+    doc["id"] = str(doc.pop("_id"))
+    # idea references are stored as ObjectId
+    if isinstance(doc.get("idea_id"), ObjectId):
+        doc["idea_id"] = str(doc["idea_id"])
+    # datetimes are left for orjson to encode
     return doc
 
 # --------- Seed data on first run ---------
 
-def ensure_seed_data():
-    # If there are ideas already, skip
-    count = db["idea"].count_documents({})
+async def ensure_seed_data():
+    # Claim the seed marker; only the first worker to insert it ever seeds
+    try:
+        await db["_meta"].insert_one({"_id": "seeded", "at": datetime.now(timezone.utc)})
+    except DuplicateKeyError:
+        return
+    # Databases populated before the marker existed already have ideas
+    count = await db["idea"].estimated_document_count()
     if count > 0:
         return
+    try:
+        await seed_ideas()
+    except Exception:
+        # Release the marker so the next startup retries; the seeding error
+        # itself is re-raised and logged by the task's done-callback
+        try:
+            await db["_meta"].delete_one({"_id": "seeded"})
+        except Exception:
+            logger.exception(
+                "Could not release the seed marker; seeding will not be retried "
+                "until the _meta 'seeded' document is removed"
+            )
+        raise
+    # Drop any list cached while seeding was still in progress
+    invalidate_ideas()
+
+async def seed_ideas():
     # Seed three ideas
     ideas = [
         {
@@ -77,36 +132,55 @@ def ensure_seed_data():
             "link": "https://example.com/travel-optimizer"
         },
     ]
-    inserted_ids = []
-    for idea in ideas:
-        inserted_ids.append(create_document("idea", idea))
+    inserted_ids = [ObjectId(_id) for _id in await create_documents("idea", ideas)]
     # Add comments and votes
-    if inserted_ids:
-        # comments
-        create_document("comment", {"idea_id": inserted_ids[0], "author": "Maya", "content": "Love this!"})
-        create_document("comment", {"idea_id": inserted_ids[0], "author": "Ravi", "content": "Would use at work."})
-        create_document("comment", {"idea_id": inserted_ids[1], "author": "Chris", "content": "Nice concept."})
-        # votes
-        for i in range(5):
-            create_document("vote", {"idea_id": inserted_ids[0], "voter": f"user_{i}"})
-        for i in range(3):
-            create_document("vote", {"idea_id": inserted_ids[1], "voter": f"user_{i}"})
-        for i in range(8):
-            create_document("vote", {"idea_id": inserted_ids[2], "voter": f"user_{i}"})
+    await create_documents("comment", [
+        {"idea_id": inserted_ids[0], "author": "Maya", "content": "Love this!"},
+        {"idea_id": inserted_ids[0], "author": "Ravi", "content": "Would use at work."},
+        {"idea_id": inserted_ids[1], "author": "Chris", "content": "Nice concept."},
+    ])
+    await create_documents("vote", [
+        {"idea_id": idea_id, "voter": f"user_{i}"}
+        for idea_id, n in zip(inserted_ids, (5, 3, 8))
+        for i in range(n)
+    ])
 
 # --------- Startup ---------
 
+_seed_task = None
+
+def report_seed_failure(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Seeding sample data failed", exc_info=task.exception())
+
 @app.on_event("startup")
-def startup_event():
-    ensure_seed_data()
+async def startup_event():
+    global _seed_task
+    if db is None:
+        logger.warning("Database not configured; skipping migration, seeding and index creation")
+        return
+    # Legacy string idea_id references must be converted before serving
+    await migrate_idea_ids()
+    # Seed in the background so startup is not blocked on the inserts
+    _seed_task = asyncio.create_task(ensure_seed_data())
+    _seed_task.add_done_callback(report_seed_failure)
     # Enforce uniqueness: one vote per voter per idea
     try:
-        db["vote"].create_index([("idea_id", 1), ("voter", 1)], unique=True)
+        await db["vote"].create_index([("idea_id", 1), ("voter", 1)], unique=True)
     except Exception:
         pass
+    # Indexes backing the per-idea counts and the newest-first comment listing
+    for collection, keys in [
+        ("vote", [("idea_id", 1), ("created_at", 1)]),
+        ("comment", [("idea_id", 1), ("created_at", -1)]),
+    ]:
+        try:
+            await db[collection].create_index(keys)
+        except Exception:
+            pass
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "Vibe Ideas API"}
 
 # --------- Query helpers ---------
@@ -121,93 +195,172 @@ def get_time_filter(period: str):
         return {}
     return {"created_at": {"$gte": start}}
 
+def count_lookup(collection: str, alias: str, time_filter: dict):
+    """$lookup stage counting documents in `collection` that reference the idea"""
+    match = {"$expr": {"$eq": ["$idea_id", "$$iid"]}}
+    match.update(time_filter)
+    return {
+        "$lookup": {
+            "from": collection,
+            "let": {"iid": "$_id"},
+            "pipeline": [{"$match": match}, {"$count": "n"}],
+            "as": alias,
+        }
+    }
+
+def parse_object_id(value: str) -> ObjectId:
+    # Reject malformed ids up front, before any database work
+    if not ObjectId.is_valid(value):
+        raise HTTPException(status_code=400, detail="Invalid id")
+    return ObjectId(value)
+
+async def idea_exists(idea_id: ObjectId) -> bool:
+    if idea_id in known_ideas:
+        return True
+    if not await db["idea"].find_one({"_id": idea_id}, {"_id": 1}):
+        return False
+    known_ideas[idea_id] = True
+    return True
+
+async def rank_ideas(period: Optional[str], sort_key: str, limit: int):
+    # Compute vote and comment counts server-side in a single aggregation,
+    # considering the time filter when applicable
+    time_filter = get_time_filter(period) if period else {}
+    pipeline = [
+        count_lookup("vote", "v", time_filter),
+        count_lookup("comment", "c", time_filter),
+        {"$addFields": {
+            "votes": {"$ifNull": [{"$arrayElemAt": ["$v.n", 0]}, 0]},
+            "comments": {"$ifNull": [{"$arrayElemAt": ["$c.n", 0]}, 0]},
+        }},
+        {"$project": {"v": 0, "c": 0}},
+        {"$sort": {sort_key: -1, "_id": 1}},
+        {"$limit": limit},
+    ]
+    return [serialize_doc(idea) async for idea in db["idea"].aggregate(pipeline)]
+
 # --------- API endpoints ---------
 
-@app.get("/api/ideas")
-def list_ideas(period: Optional[str] = None, sort: str = "votes"):
-    # Fetch ideas
-    ideas = get_documents("idea")
-    # For each idea, compute vote and comment counts considering time filter when applicable
-    time_filter = get_time_filter(period) if period in ("week", "month") else {}
-    enriched = []
-    for idea in ideas:
-        idea_id = str(idea["_id"]) if "_id" in idea else idea.get("id")
-        # Votes
-        vote_filter = {"idea_id": idea_id}
-        if time_filter:
-            vote_filter.update(time_filter)
-        votes = db["vote"].count_documents(vote_filter)
-        # Comments
-        comment_filter = {"idea_id": idea_id}
-        if time_filter:
-            comment_filter.update(time_filter)
-        comments = db["comment"].count_documents(comment_filter)
-        doc = serialize_doc(idea)
-        doc["votes"] = votes
-        doc["comments"] = comments
-        enriched.append(doc)
-    # Sort
-    if sort == "comments":
-        enriched.sort(key=lambda x: x.get("comments", 0), reverse=True)
-    else:
-        enriched.sort(key=lambda x: x.get("votes", 0), reverse=True)
-    return enriched
+@app.get("/api/ideas", response_model=None)
+async def list_ideas(
+    period: Optional[str] = None,
+    sort: str = "votes",
+    limit: int = Query(50, ge=1, le=500),
+):
+    if period not in ("week", "month"):
+        period = None
+    sort_key = "comments" if sort == "comments" else "votes"
+    body = ideas_cache.get((period, sort_key, limit))
+    if body is None:
+        generation = ideas_generation
+        body = ORJSONResponse(await rank_ideas(period, sort_key, limit)).body
+        if generation == ideas_generation:
+            ideas_cache[(period, sort_key, limit)] = body
+    return Response(body, media_type="application/json", headers={"Cache-Control": "public, max-age=30"})
 
-@app.get("/api/ideas/{idea_id}")
-def get_idea(idea_id: str):
-    doc = db["idea"].find_one({"_id": ObjectId(idea_id)})
+@app.get("/api/ideas/{idea_id}", response_model=None)
+async def get_idea(idea_id: str, limit: int = Query(100, ge=1, le=500)):
+    oid = parse_object_id(idea_id)
+    doc = await db["idea"].find_one({"_id": oid})
     if not doc:
         raise HTTPException(status_code=404, detail="Idea not found")
     # Include comments
-    comments = list(db["comment"].find({"idea_id": idea_id}).sort("created_at", -1))
+    cursor = (
+        db["comment"]
+        .find({"idea_id": oid}, {"_id": 1, "author": 1, "content": 1, "created_at": 1})
+        .sort("created_at", -1)
+        .batch_size(50)
+        .limit(limit)
+    )
+    comments = await cursor.to_list(length=limit)
     comments = [serialize_doc(c) for c in comments]
-    votes = db["vote"].count_documents({"idea_id": idea_id})
+    votes = await db["vote"].count_documents({"idea_id": oid})
     idea = serialize_doc(doc)
     idea["comments_list"] = comments
     idea["votes"] = votes
-    return idea
+    return ORJSONResponse(idea)
 
-@app.post("/api/ideas")
-def create_idea(payload: IdeaCreate):
+@app.post("/api/ideas", response_model=None)
+async def create_idea(payload: IdeaCreate):
     data = payload.model_dump()
     # Normalize link if provided (prepend https:// if missing scheme)
     link = data.get("link")
     if link:
-        if not (link.startswith("http://") or link.startswith("https://")):
-            data["link"] = f"https://{link}"
-    new_id = create_document("idea", data)
-    doc = db["idea"].find_one({"_id": ObjectId(new_id)})
-    return serialize_doc(doc)
-
-@app.post("/api/comments")
-def add_comment(payload: CommentCreate):
+        if not SCHEME_RE.match(link):
+            link = data["link"] = f"https://{link}"
+        try:
+            parts = urlsplit(link)
+        except ValueError:
+            parts = None
+        if parts is None or parts.scheme.lower() not in ("http", "https") or not parts.netloc:
+            raise HTTPException(status_code=400, detail="Invalid link")
+    new_id = await create_document("idea", data)
+    invalidate_ideas()
+    oid = ObjectId(new_id)
+    known_ideas[oid] = True
+    doc = await db["idea"].find_one({"_id": oid})
+    return ORJSONResponse(serialize_doc(doc))
+
+@app.post("/api/comments", response_model=None)
+async def add_comment(payload: CommentCreate):
     # Validate idea exists
-    if not db["idea"].find_one({"_id": ObjectId(payload.idea_id)}):
+    idea_id = parse_object_id(payload.idea_id)
+    if not await idea_exists(idea_id):
         raise HTTPException(status_code=404, detail="Idea not found")
-    _id = create_document("comment", payload)
-    doc = db["comment"].find_one({"_id": ObjectId(_id)})
-    return serialize_doc(doc)
+    data = payload.model_dump()
+    data["idea_id"] = idea_id
+    _id = await create_document("comment", data)
+    invalidate_ideas()
+    doc = await db["comment"].find_one({"_id": ObjectId(_id)})
+    return ORJSONResponse(serialize_doc(doc))
 
-@app.post("/api/votes")
-def add_vote(payload: VoteCreate, request: Request):
+@app.post("/api/votes", response_model=None)
+async def add_vote(payload: VoteCreate, request: Request):
     # Validate idea exists
-    if not db["idea"].find_one({"_id": ObjectId(payload.idea_id)}):
+    idea_id = parse_object_id(payload.idea_id)
+    if not await idea_exists(idea_id):
         raise HTTPException(status_code=404, detail="Idea not found")
     # Determine voter identity (prefer provided voter, fall back to client IP)
     voter_identity = payload.voter or (request.client.host if request.client else None)
     if not voter_identity:
         # If no voter identity can be determined, reject to prevent duplicate votes
         raise HTTPException(status_code=400, detail="Missing voter identity")
-    # Enforce one vote per voter per idea
-    existing = db["vote"].find_one({"idea_id": payload.idea_id, "voter": voter_identity})
-    if existing:
+    # Enforce one vote per voter per idea in a single atomic upsert
+    # Match what Mongo returns on read: naive UTC at millisecond precision
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    vote = {"idea_id": idea_id, "voter": voter_identity, "created_at": now, "updated_at": now}
+    try:
+        result = await db["vote"].update_one(
+            {"idea_id": vote["idea_id"], "voter": voter_identity},
+            {"$setOnInsert": vote},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # Lost a race with a concurrent upsert for the same voter
+        raise HTTPException(status_code=409, detail="Already voted")
+    if result.upserted_id is None:
         raise HTTPException(status_code=409, detail="Already voted")
-    _id = create_document("vote", {"idea_id": payload.idea_id, "voter": voter_identity})
-    doc = db["vote"].find_one({"_id": ObjectId(_id)})
-    return serialize_doc(doc)
+    invalidate_ideas()
+    vote["_id"] = result.upserted_id
+    return ORJSONResponse(serialize_doc(vote))
+
+# Last /test payload and when it was computed; probes within the TTL reuse it
+TEST_CACHE_TTL = 5.0
+_test_cache = (0.0, None)
+_test_lock = asyncio.Lock()
 
 @app.get("/test")
-def test_database():
+async def test_database():
+    global _test_cache
+    async with _test_lock:
+        checked_at, response = _test_cache
+        if response is None or time.monotonic() - checked_at >= TEST_CACHE_TTL:
+            response = await check_database()
+            _test_cache = (time.monotonic(), response)
+    return response
+
+async def check_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -223,7 +376,7 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
+                collections = await db.list_collection_names()
                 response["collections"] = collections[:10]
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
@@ -232,7 +385,6 @@ def test_database():
             response["database"] = "⚠️  Available but not initialized"
     except Exception as e:
         response["database"] = f"❌ Error: {str(e)[:50]}"
-    import os
     response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
     response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
     return response
@@ -240,4 +392,9 @@ def test_database():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Each worker keeps its own idea list cache, so with WEB_CONCURRENCY > 1 a
+    # write only invalidates the worker that handled it; others may serve
+    # stale counts until their cache expires
+    workers = int(os.getenv("WEB_CONCURRENCY", 1))
+    # "auto" picks uvloop and httptools when installed
+    uvicorn.run("main:app", host="0.0.0.0", port=port, loop="auto", http="auto", workers=workers)
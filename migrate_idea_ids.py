@@ -0,0 +1,49 @@
+"""
+Idea Reference Migration
+
+Converts `idea_id` on comments and votes from the string form previously
+stored to a native ObjectId. The API only matches ObjectId references, so
+unconverted documents are invisible to counts and comment listings.
+
+This runs automatically in the app's startup hook before any request is
+served, and is idempotent, so it is safe across restarts and concurrent
+workers. It can also be run by hand with: python migrate_idea_ids.py
+"""
+
+import asyncio
+
+from pymongo.errors import DuplicateKeyError
+
+from database import db
+
+# String references that are valid ObjectId hex
+LEGACY_FILTER = {"idea_id": {"$type": "string", "$regex": "^[0-9a-fA-F]{24}$"}}
+TO_OBJECT_ID = [{"$set": {"idea_id": {"$toObjectId": "$idea_id"}}}]
+
+
+async def migrate_idea_ids():
+    """Convert legacy string idea_id references; returns converted counts per collection"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    converted = {}
+    for collection_name in ["comment", "vote"]:
+        collection = db[collection_name]
+        try:
+            result = await collection.update_many(LEGACY_FILTER, TO_OBJECT_ID)
+            converted[collection_name] = result.modified_count
+        except DuplicateKeyError:
+            # A voter re-voted under the ObjectId key before the conversion ran.
+            # Settle the rest one document at a time, dropping legacy duplicates.
+            converted[collection_name] = 0
+            async for doc in collection.find(LEGACY_FILTER, {"_id": 1}):
+                try:
+                    result = await collection.update_one({"_id": doc["_id"], **LEGACY_FILTER}, TO_OBJECT_ID)
+                    converted[collection_name] += result.modified_count
+                except DuplicateKeyError:
+                    await collection.delete_one({"_id": doc["_id"]})
+    return converted
+
+
+if __name__ == "__main__":
+    for name, count in asyncio.run(migrate_idea_ids()).items():
+        print(f"{name}: converted {count} documents")